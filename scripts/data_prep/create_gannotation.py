@@ -5,6 +5,7 @@
 from utils import get_seq_combos, write_video
 
 import argparse
+import av
 import cv2
 import dlib
 import GANnotation.GANnotation as GANnotation
@@ -14,56 +15,277 @@ import os
 import sys
 import torch
 
+from itertools import groupby
+from multiprocessing import Pool
 from sys import stderr
 
 COMPRESSION_LEVEL = 'c0'  # c0, c23, c40
 FPS = 30
+SAMPLE_STRIDE = 3  # Only every SAMPLE_STRIDE-th frame is encoded.
+# Number of threads FFmpeg decodes each video with.  Kept low since a video
+# is already encoded in parallel for every CPU.
+DECODE_THREADS = 2
+# Images are downscaled so their shorter side is at most DETECT_SIZE pixels
+# before face detection.
+DETECT_SIZE = 240
+# Maximum mean absolute pixel difference between downscaled frames for a
+# previous face detection to be reused.  Frames are compared in the video's
+# luma, which is usually limited range (16-235) rather than full range grey.
+CACHE_THRESHOLD = 2.0
+# Planar YUV formats whose first plane is the luma of the frame.
+YUV_PLANAR_FORMATS = {'yuv420p', 'yuvj420p', 'yuv422p', 'yuvj422p',
+                      'yuv444p', 'yuvj444p'}
+DETECT_INTERVAL = 5  # Number of sampled frames between face detections.
+# Indices of the dlib landmarks used by GANnotation.
+# The inner corners of the mouth (60 and 64) are not used.
+KEEP_IDX = np.array([i for i in range(68) if i not in (60, 64)])
 
 dirname = os.path.dirname(__file__)
-face_detector = dlib.get_frontal_face_detector()
-face_predictor = dlib.shape_predictor(os.path.join(
-    dirname, 'models/shape_predictor_68_face_landmarks.dat'))
+face_detector = None
+face_predictor = None
+
+def init_face_models():
+    """
+    Loads the dlib face detector and landmark predictor.  Must be called once
+    per process before any faces are detected.
+    """
+    global face_detector, face_predictor
+    face_detector = dlib.get_frontal_face_detector()
+    face_predictor = dlib.shape_predictor(os.path.join(
+        dirname, 'models/shape_predictor_68_face_landmarks.dat'))
+
+def landmarks_to_np(landmarks):
+    """
+    Converts dlib landmarks to the points used by GANnotation.
+
+    Args:
+        landmarks: A dlib.full_object_detection with 68 landmarks.
+
+    Returns:
+        Numpy array of 66 points with shape (66, 2).
+    """
+    # Fetch every part in one call and fill the array without building
+    # intermediate lists.
+    points = np.fromiter((v for p in landmarks.parts() for v in (p.x, p.y)),
+                         dtype=np.int32, count=136)
+    return points.reshape(68, 2)[KEEP_IDX]
+
+def upsample_points(points, n_frames):
+    """
+    Linearly interpolates points sampled every SAMPLE_STRIDE frames back to the
+    full frame rate.
+
+    Args:
+        points: Numpy array of points with shape (N, ...), where the i-th entry
+            belongs to frame i * SAMPLE_STRIDE.
+        n_frames: Number of frames at the full frame rate.  Frames after the
+            last sample take the value of the last sample.
+
+    Returns:
+        Numpy array of points with shape (n_frames, ...).
+    """
+    if len(points) == 0:
+        return points
+    t = np.arange(n_frames) / SAMPLE_STRIDE
+    lo = np.minimum(t.astype(int), len(points) - 1)
+    hi = np.minimum(lo + 1, len(points) - 1)
+    w = (t - lo).reshape((-1,) + (1,) * (points.ndim - 1))
+    return points[lo] * (1 - w) + points[hi] * w
+
+def downscale(gray):
+    """
+    Downscales a greyscale image for face detection.
+
+    Args:
+        gray: Greyscale image as a np.ndarray.
+
+    Returns:
+        Image downscaled so its shorter side is at most DETECT_SIZE pixels.
+    """
+    scale = min(gray.shape[:2]) / DETECT_SIZE
+    if scale <= 1:
+        return gray
+    return cv2.resize(gray, (0, 0), fx=1/scale, fy=1/scale,
+                      interpolation=cv2.INTER_AREA)
+
+def detect_face(gray, small):
+    """
+    Finds the bounding box of a face.
+
+    Detection is first run on a downscaled copy of the image without
+    upsampling, which is far cheaper than running the detector at full
+    resolution.  dlib's HOG detector cannot find faces smaller than 80x80
+    pixels without upsampling, so faces that shrink below that are missed.  If
+    no face is found, detection is retried on the full resolution image, and
+    only then on the full resolution image upsampled once.
+
+    Args:
+        gray: Greyscale image as a np.ndarray.
+        small: `gray` downscaled with downscale().
+
+    Returns:
+        Bounding box of the first face found as a dlib.rectangle in the
+        coordinates of `gray`, or None if no face was found.
+    """
+    rects = face_detector(small, 0)
+    if len(rects) > 0:
+        r = rects[0]
+        scale = gray.shape[0] / small.shape[0]
+        return dlib.rectangle(int(r.left() * scale),
+                              int(r.top() * scale),
+                              int(r.right() * scale),
+                              int(r.bottom() * scale))
+
+    if small is not gray:
+        rects = face_detector(gray, 0)
+    if len(rects) == 0:
+        # Last resort for faces smaller than 80x80 pixels.
+        rects = face_detector(gray, 1)
+    return rects[0] if len(rects) > 0 else None
+
+def frame_to_gray(frame):
+    """
+    Gets the luma of a decoded video frame as a greyscale image.
+
+    For planar YUV frames the luma plane is used as is, without conversion.
+    Unlike a greyscale conversion from BGR, this is usually limited range
+    (16-235).
+
+    Args:
+        frame: A PyAV VideoFrame.
+
+    Returns:
+        Greyscale image as a np.ndarray.
+    """
+    if frame.format.name not in YUV_PLANAR_FORMATS:
+        return frame.to_ndarray(format='gray')
+    plane = frame.planes[0]
+    gray = np.frombuffer(plane, dtype=np.uint8).reshape(-1, plane.line_size)
+    # Rows may be padded beyond the width of the frame.
+    return np.ascontiguousarray(gray[:plane.height, :plane.width])
 
 def compute_video_encoding(video):
     """
     Computes the GANnotation encoding for a video.
 
+    Only every SAMPLE_STRIDE-th frame is converted and encoded.  The points for
+    the remaining frames are interpolated.
+
     Args:
-        video: A cv2.VideoCapture video to encode.
+        video: A PyAV container of the video to encode.
 
     Return:
-        Numpy array encoding.
+        Tuple in the format (encoding, cache_hits, cache_misses), where
+        encoding is a Numpy array with shape (T, 132) whose rows hold the
+        flattened (66, 2) points for each frame, and cache_hits and
+        cache_misses count the detections that were and were not reused.
     """
 
-    video_points = []
-    while True:
-        ret, frame = video.read()
-        if not ret:
-            break
+    stream = video.streams.video[0]
+    stream.thread_type = 'AUTO'
+    stream.thread_count = DECODE_THREADS
+
+    # Preallocate space for the points of every sampled frame.
+    n_samples = stream.frames // SAMPLE_STRIDE + 1
+    video_points = np.empty((n_samples, 132), dtype=np.float32)
+    n_points = 0
+    prev_small = None
+    prev_rect = None
+    cache_hits = 0
+    cache_misses = 0
+    frame_idx = 0
+    n_frames = 0
+    for frame in video.decode(stream):
+        # Skip converting frames that are not sampled.
+        if n_frames % SAMPLE_STRIDE != 0:
+            n_frames += 1
+            continue
 
-        # Find landmarks/points in frame.
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        rects = face_detector(gray, 1)
-        if (len(rects) == 0):
-            break  # No face found.
-        landmarks = face_predictor(gray, rects[0])
-
-        # Convert landmarks to a numpy array.
-        points = []
-        for i in range(0, landmarks.num_parts):
-            if i == 60 or i == 64:
-                continue
-            point = landmarks.part(i)
-            points.append([point.x, point.y])
-        points = np.array(points)
+        # Use the luma plane for face detection.  A BGR copy is only needed by
+        # GANnotation.
+        gray = frame_to_gray(frame)
+        bgr = frame.to_ndarray(format='bgr24')
 
-        img, maps, pts = gann_utils.process_image(frame, points)
-        video_points.append(pts)
+        # Find landmarks/points in frame.
+        # Faces are only detected every DETECT_INTERVAL frames.  In between,
+        # the last detected face is used as the region for the landmark
+        # predictor.  The last detection is also reused if the frame has
+        # barely changed since.
+        if prev_rect is not None and frame_idx % DETECT_INTERVAL != 0:
+            rect = prev_rect
+        else:
+            small = downscale(gray)
+            if prev_small is not None and \
+               np.abs(small.astype(np.int16) - prev_small).mean() < CACHE_THRESHOLD:
+                rect = prev_rect
+                cache_hits += 1
+            else:
+                rect = detect_face(gray, small)
+                if rect is None:
+                    break  # No face found.
+                prev_small = small.astype(np.int16)
+                prev_rect = rect
+                cache_misses += 1
+        landmarks = face_predictor(gray, rect)
+        frame_idx += 1
+
+        points = landmarks_to_np(landmarks)
+        img, maps, pts = gann_utils.process_image(bgr, points)
+        if n_points == len(video_points):
+            # The container reported fewer frames than it has.
+            video_points = np.concatenate(
+                (video_points, np.empty_like(video_points)))
+        video_points[n_points] = np.reshape(pts, -1)
+        n_points += 1
+        n_frames += 1
+
+    points = upsample_points(video_points[:n_points], n_frames)
+    return points, cache_hits, cache_misses
+
+get_encoding_path = lambda enc_dir, driver_id: '{}/{}.npy'.format(enc_dir, driver_id)
+
+def encode_sequence(job):
+    """
+    Computes the GANnotation encoding for a video sequence and saves it to
+    disk.  Meant to be run by worker processes initialized with
+    init_face_models().
 
-    video_points = np.array(video_points).transpose().swapaxes(0, 1)
-    return video_points
+    Args:
+        job: Tuple in the format (seq_id, video_path, encoding_path).
 
-get_encoding_path = lambda enc_dir, driver_id: '{}/{}.txt'.format(enc_dir, driver_id)
+    Returns:
+        True if the encoding was saved, False if the video could not be read
+        or no face was found.
+    """
+    seq_id, video_path, encoding_path = job
+    print('Computing encoding for sequence {}...'.format(seq_id))
+    container = None
+    try:
+        container = av.open(video_path)
+        points, cache_hits, cache_misses = compute_video_encoding(container)
+    except av.error.FFmpegError as e:
+        # Missing or corrupt video.
+        print('Failed to read video for sequence {}: {}'.format(seq_id, e),
+              file=stderr)
+        return False
+    finally:
+        if container is not None:
+            container.close()
+    print('Detection cache for sequence {}: {} hits, {} misses'.format(
+        seq_id, cache_hits, cache_misses))
+    if len(points) == 0:
+        print('Failed to find face in first frame of sequence {}. ' \
+              'Encoding not saved.'.format(seq_id), file=stderr)
+        return False
+    try:
+        np.save(encoding_path, points.astype(np.float32))
+    except KeyboardInterrupt as e:
+        # Safely handle premature termination.
+        # Remove unfinished file.
+        if os.path.exists(encoding_path):
+            os.remove(encoding_path)
+        raise e
+    return True
 
 def get_gann_cropped_face(image):
     """
@@ -75,25 +297,16 @@ def get_gann_cropped_face(image):
     Returns:
         Cropped image of a face as a torch.FloatTensor.
     """
-    # Convert image to RGB.
+    # Convert image to RGB and greyscale.
     rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
     # Find landmarks/points in frame.
-    gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
-    rects = face_detector(gray, 1)
-    if (len(rects) == 0):
+    rect = detect_face(gray, downscale(gray))
+    if rect is None:
         return None  # No face found.
-    landmarks = face_predictor(gray, rects[0])
-
-    # Convert landmarks to a numpy array.
-    # TODO: Make this a helper function.
-    points = []
-    for i in range(0, landmarks.num_parts):
-        if i == 60 or i == 64:
-            continue
-        point = landmarks.part(i)
-        points.append([point.x, point.y])
-    points = np.array(points)
+    landmarks = face_predictor(gray, rect)
+    points = landmarks_to_np(landmarks)
 
     cropped, _, _ = gann_utils.process_image(rgb, points)
     return cropped
@@ -122,25 +335,23 @@ def main(data_dir):
     print('Computing video encodings...')
     if not os.path.exists(output_enc_dir):
         os.makedirs(output_enc_dir)
-    enc_count = 0
-    for source_id, _ in pairs:
-        encoding_path = get_encoding_path(output_enc_dir, source_id)
-        if os.path.exists(encoding_path):
+    # List existing files once rather than checking for each file separately.
+    existing_encodings = set(os.listdir(output_enc_dir))
+    jobs = []
+    for source_id in sorted({source_id for source_id, _ in pairs}):
+        if '{}.npy'.format(source_id) in existing_encodings:
             continue  # Encoding already calculated for this video sequence.
-        print('Computing encoding for sequence {}...'.format(source_id))
+        encoding_path = get_encoding_path(output_enc_dir, source_id)
         video_path = '{}/{}.mp4'.format(orig_dir, source_id)
-        cap = cv2.VideoCapture(video_path)
-        points = compute_video_encoding(cap)
-        cap.release()
-        try:
-            np.savetxt(encoding_path, points.reshape((132,-1)).transpose())
-        except KeyboardInterrupt as e:
-            # Safely handle premature termination.
-            # Remove unfinished file.
-            if os.exists(encoding_path):
-                os.remove(encoding_path)
-            raise e
-        enc_count += 1
+        jobs.append((source_id, video_path, encoding_path))
+
+    # Every sequence is encoded independently, so spread them over all CPUs.
+    enc_count = 0
+    if jobs:
+        with Pool(processes=os.cpu_count(), initializer=init_face_models) as pool:
+            for saved in pool.imap_unordered(encode_sequence, jobs):
+                if saved:
+                    enc_count += 1
 
     if enc_count == 0:
         print('No encodings were calculated')
@@ -150,55 +361,77 @@ def main(data_dir):
     print()
     print('Computing reenactments...')
 
-    # Load pre-trained model.
+    # Load pre-trained models.
+    init_face_models()
     gann_path = os.path.join(dirname, 'models/myGEN.pth')
     my_gann = GANnotation.GANnotation(path_to_model=gann_path)
 
+    # Only inference is performed, and the input shape never changes, so
+    # cuDNN can autotune its convolution algorithms once and reuse them.
+    torch.set_grad_enabled(False)
+    torch.backends.cudnn.benchmark = True
+
     image_dir = '{}/original_sequences_images/{}/images'.format(data_dir, COMPRESSION_LEVEL)
     if not os.path.exists(output_vid_dir):
         os.makedirs(output_vid_dir)
+    existing_encodings = set(os.listdir(output_enc_dir))
+    existing_videos = set(os.listdir(output_vid_dir))
+    existing_images = set(os.listdir(image_dir)) if os.path.isdir(image_dir) else set()
     reenact_count = 0
-    for source_id, driver_id in pairs:
-        output_path = '{}/{}_{}.mp4'.format(output_vid_dir, source_id, driver_id)
-        if os.path.exists(output_path):
-            # Do not recreate a video if it already exists.
-            # If the user wants to recreated a video
-            # the existing video must be deleted first.
-            continue
+    for source_id, group in groupby(sorted(pairs), key=lambda p: p[0]):
+        # Gather every driving sequence that still needs to be reenacted onto
+        # this source.
+        driver_ids = []
+        for _, driver_id in group:
+            if '{}_{}.mp4'.format(source_id, driver_id) in existing_videos:
+                # Do not recreate a video if it already exists.
+                # If the user wants to recreated a video
+                # the existing video must be deleted first.
+                continue
 
-        print('Computing reenactment for {} onto {}...'.format(driver_id, source_id))
-        # Validate that input files exist.
-        encoding_path = get_encoding_path(output_enc_dir, driver_id)
-        if not os.path.isfile(encoding_path):
-            print('Failed to find encoding for video sequence {}'.format(driver_id),
-                  file=stderr)
+            # Validate that input files exist.
+            if '{}.npy'.format(driver_id) not in existing_encodings:
+                print('Failed to find encoding for video sequence {}'.format(driver_id),
+                      file=stderr)
+                continue
+            driver_ids.append(driver_id)
+        if len(driver_ids) == 0:
             continue
-        image_path = '{}/{}.png'.format(image_dir, source_id)
-        if not os.path.isfile(image_path):
+
+        if '{}.png'.format(source_id) not in existing_images:
             print('Failed to find image for sequence {}'.format(source_id),
                   file=stderr)
             continue
 
-        points = np.loadtxt(encoding_path).transpose().reshape(66, 2, -1)
-
         # Load and transform image for inputting.
+        # This is only done once for all of the source's driving sequences.
+        image_path = '{}/{}.png'.format(image_dir, source_id)
         image = cv2.imread(image_path)
         cropped = get_gann_cropped_face(image)
+        if cropped is None:
+            print('Failed to find face in image for sequence {}'.format(source_id),
+                  file=stderr)
+            continue
 
-        # Compute reenactment.
-        frames, _ = my_gann.reenactment(cropped, points)
-
-        output_path = os.path.abspath(output_path)
-        print('Writing video to "{}"'.format(output_path))
-        try:
-            write_video(frames, FPS, (128, 128), output_path)
-        except KeyboardInterrupt as e:
-            # Safely handle premature termination.
-            # Remove unfinished file.
-            if os.exists(output_path):
-                os.remove(output_path)
-            raise e
-        reenact_count += 1
+        for driver_id in driver_ids:
+            # Compute reenactment.
+            print('Computing reenactment for {} onto {}...'.format(driver_id, source_id))
+            encoding = np.load(get_encoding_path(output_enc_dir, driver_id))
+            points = encoding.transpose().reshape(66, 2, -1)
+            frames, _ = my_gann.reenactment(cropped, points)
+
+            output_path = '{}/{}_{}.mp4'.format(output_vid_dir, source_id, driver_id)
+            output_path = os.path.abspath(output_path)
+            print('Writing video to "{}"'.format(output_path))
+            try:
+                write_video(frames, FPS, (128, 128), output_path)
+            except KeyboardInterrupt as e:
+                # Safely handle premature termination.
+                # Remove unfinished file.
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                raise e
+            reenact_count += 1
 
     if reenact_count == 0:
         print('No reenactments were created')
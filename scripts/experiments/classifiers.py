@@ -4,6 +4,8 @@ from keras.initializers import glorot_uniform, zeros
 from keras.layers import BatchNormalization, Concatenate, Conv2D, Dense, Dropout, Flatten, Input, LeakyReLU, MaxPooling2D
 from keras.models import Model as Model
 from keras.optimizers import Adam
+from keras.utils import OrderedEnqueuer, Progbar
+import numpy as np
 
 CLASS_MODES = {'binary', 'categorical'}
 IMG_SIZE = 256
@@ -66,6 +68,40 @@ class Classifier:
                                              steps=len(generator),
                                              verbose=1)
 
+    def accuracy_with_generator(self, generator, workers=1):
+        """
+        Calculates the accuracy of a binary model with a data generator.
+        Only predictions are computed; the loss and compiled metrics are
+        skipped.  For a generator with samples from a single class, this is
+        the recall for that class.
+
+        Args:
+            generator: The data generator with samples to evaluate.
+            workers: Number of threads loading batches ahead of the model.
+
+        Returns:
+            Fraction of samples whose rounded prediction matches their label.
+        """
+        # Iterators build their sample order lazily and without a lock.  Build
+        # it before the worker threads start so they all share one order.
+        generator.on_epoch_end()
+        enqueuer = OrderedEnqueuer(generator, use_multiprocessing=False)
+        enqueuer.start(workers=workers)
+        batches = enqueuer.get()
+        progbar = Progbar(target=len(generator))
+        correct = 0
+        total = 0
+        try:
+            for i in range(len(generator)):
+                x, y = next(batches)
+                pred = self.model.predict_on_batch(x)
+                correct += np.sum(np.round(pred[:, 0]) == y)
+                total += len(y)
+                progbar.update(i + 1)
+        finally:
+            enqueuer.stop()
+        return correct / total
+
     def set_metrics(self, metrics):
         """
         Sets the metrics used to judge the performance of the model.
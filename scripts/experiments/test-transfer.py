@@ -55,7 +55,7 @@ from utils import load_single_class_generators
 # Silence Tensorflow warnings.
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
-def main(data_dir, models_dir, mtype, output_file, batch_size=16):
+def main(data_dir, models_dir, mtype, output_file, batch_size=16, workers=4):
     """
     Tests transferred models on every class type.
 
@@ -66,6 +66,8 @@ def main(data_dir, models_dir, mtype, output_file, batch_size=16):
         mtype: Architecture of models to test.
         output_file: CSV file to output to.
         batch_size: Number of images to process at a time.
+        workers: Number of threads loading images while the model is
+            evaluated.
     """
     # Make sure model is valid.
     if not mtype in MODEL_MAP:
@@ -77,6 +79,7 @@ def main(data_dir, models_dir, mtype, output_file, batch_size=16):
     print('Loading models from "{}"'.format(models_dir))
     print('Outputting to "{}"'.format(output_file))
     print('Batch size: {}'.format(batch_size))
+    print('Workers: {}'.format(workers))
 
     # Open output file.  Initialize with headers if it does not exist.
     init_output = not os.path.exists(output_file)
@@ -100,6 +103,9 @@ def main(data_dir, models_dir, mtype, output_file, batch_size=16):
               file=stderr)
         exit(1)
 
+    # Build the model once.  Only the weights differ between models.
+    model = MODEL_MAP[mtype]()
+
     # Calculate recall for all models.
     for model_name in sorted(os.listdir(mtype_dir)):
         weights_dir = os.path.join(mtype_dir, model_name)
@@ -117,10 +123,8 @@ def main(data_dir, models_dir, mtype, output_file, batch_size=16):
 
         print('\nTesting model "{}"...'.format(model_name))
 
-        # Load model.
-        model = MODEL_MAP[mtype]()
+        # Load weights.
         model.load(best_path)
-        model.set_metrics(['acc'])
 
         # Calculate recall against each class.
         recalls = {}
@@ -129,7 +133,7 @@ def main(data_dir, models_dir, mtype, output_file, batch_size=16):
             gen.reset()
 
             # Test model on every compression level.
-            _, recalls[c] = model.evaluate_with_generator(gen)
+            recalls[c] = model.accuracy_with_generator(gen, workers=workers)
 
         # Write data.
         orig_class, _, trans_class = model_name.split('-')
@@ -159,6 +163,9 @@ if __name__ == '__main__':
         parser.add_argument('-b', '--batch-size', metavar='batch_size', type=int,
                             required=False, nargs=1, default=[16],
                             help='number of images to read at a time')
+        parser.add_argument('-j', '--workers', metavar='workers', type=int,
+                            required=False, nargs=1, default=[4],
+                            help='number of threads loading images')
         parser.add_argument('-g', '--gpu-fraction', metavar='gpu_fraction', type=float,
                             required=False, nargs=1, default=[1.0],
                             help='maximum fraction of the GPU\'s memory the ' \
@@ -170,6 +177,7 @@ if __name__ == '__main__':
         mtype = args.mtype[0]
         output_file = args.output_file[0]
         batch_size = args.batch_size[0]
+        workers = args.workers[0]
         gpu_frac = args.gpu_fraction[0]
 
         # Validate arguments.
@@ -179,6 +187,9 @@ if __name__ == '__main__':
         if not os.path.isdir(models_dir):
             print('"{}" is not a directory'.format(models_dir), file=stderr)
             exit(2)
+        if workers < 1:
+            print('workers must be at least 1', file=stderr)
+            exit(2)
         if gpu_frac < 0 or gpu_frac > 1:
             print('gpu-fraction must be between 0.0 and 1.0', file=stderr)
             exit(2)
@@ -189,7 +200,8 @@ if __name__ == '__main__':
         sess = tf.Session(config=config)
         set_session(sess)
 
-        main(data_dir, models_dir, mtype, output_file, batch_size=batch_size)
+        main(data_dir, models_dir, mtype, output_file, batch_size=batch_size,
+             workers=workers)
 
     except KeyboardInterrupt:
         print('Program terminated prematurely')